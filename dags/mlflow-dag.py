@@ -24,9 +24,13 @@ import logging
 
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split, GridSearchCV
+import pyarrow as pa
+from sklearn.model_selection import train_test_split
 
 import include.metrics as metrics
+from include.mlflow_setup import init_mlflow
+from include.lgbm_search import LGB_BASE_PARAMS, lgb_grid_search
+from include.gcs_parquet import read_parquet, write_parquet
 
 
 @dag(
@@ -46,102 +50,90 @@ def mlflow_example():
         SELECT * FROM `bigquery-public-data.ml_datasets.census_adult_income`
         """
 
-        return bq.get_pandas_df(sql=sql, dialect='standard')
+        # Stream the result set as Arrow record batches over the BigQuery Storage Read API
+        result = bq.get_client().query(sql).result()
+        return result.to_arrow(create_bqstorage_client=True).to_pandas(
+            types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get
+        )
 
 
     @task
-    def preprocessing(df: pd.DataFrame):
-        """Clean Data and prepare for feature engineering
+    def prepare_features(df: pd.DataFrame):
+        """Clean Data and build model features
         
-        Returns pandas dataframe via Xcom to GCS bucket.
+        Returns GCS URI of the features saved as Parquet via XCom.
 
         Keyword arguments:
         df -- Raw data pulled from BigQuery to be processed. 
         """
 
-        df.dropna(inplace=True)
-        df.drop_duplicates(inplace=True)
+        # Drop incomplete rows, then duplicates, renumbering the index in the same pass
+        df = df.dropna().drop_duplicates(ignore_index=True)
 
         # Clean Categorical Variables (strings)
-        cols = df.columns
-        for col in cols:
-            if df.dtypes[col]=='object':
-                df[col] =df[col].apply(lambda x: x.rstrip().lstrip())
+        obj_cols = df.select_dtypes(include=['object', 'string']).columns
+        df[obj_cols] = df[obj_cols].apply(lambda s: s.str.strip())
 
         # Rename up '?' values as 'Unknown'
-        df['workclass'] = df['workclass'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['occupation'] = df['occupation'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['native_country'] = df['native_country'].apply(lambda x: 'Unknown' if x == '?' else x)
+        unknown_cols = ['workclass', 'occupation', 'native_country']
+        df[unknown_cols] = df[unknown_cols].replace('?', 'Unknown')
+
+        # Store low cardinality strings as categoricals so get_dummies and comparisons run on integer codes
+        cat_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country', 'marital_status']
+        df[cat_cols] = df[cat_cols].astype('category')
 
         # Drop Extra/Unused Columns
         df.drop(columns=['education_num', 'relationship', 'functional_weight'], inplace=True)
 
-        return df
-
-
-    @task
-    def feature_engineering(df: pd.DataFrame):
-        """Feature engineering step
-        
-        Returns pandas dataframe via XCom to GCS bucket.
-
-        Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
-        """
-
-        # Onehot encoding 
-        df = pd.get_dummies(df, prefix='workclass', columns=['workclass'])
-        df = pd.get_dummies(df, prefix='education', columns=['education'])
-        df = pd.get_dummies(df, prefix='occupation', columns=['occupation'])
-        df = pd.get_dummies(df, prefix='race', columns=['race'])
-        df = pd.get_dummies(df, prefix='sex', columns=['sex'])
-        df = pd.get_dummies(df, prefix='income_bracket', columns=['income_bracket'])
-        df = pd.get_dummies(df, prefix='native_country', columns=['native_country'])
+        # Onehot encoding
+        dummy_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country']
+        df = pd.get_dummies(df, columns=dummy_cols, dtype=np.int8)
 
         # Bin Ages
-        df['age_bins'] = pd.cut(x=df['age'], bins=[16,29,39,49,59,100], labels=[1, 2, 3, 4, 5])
+        df['age_bins'] = (np.digitize(df['age'].to_numpy(), bins=[29, 39, 49, 59], right=True) + 1).astype(np.int8)
 
         # Dependent Variable
-        df['never_married'] = df['marital_status'].apply(lambda x: 1 if x == 'Never-married' else 0) 
+        df['never_married'] = (df['marital_status'] == 'Never-married').astype(np.int8)
 
         # Drop redundant column
         df.drop(columns=['income_bracket_<=50K', 'marital_status', 'age'], inplace=True)
 
-        return df
+        # Downcast remaining numeric columns, LightGBM bins float32 and sklearn accepts it as is
+        float_cols = df.select_dtypes(include=['float64', 'int64']).columns
+        df[float_cols] = df[float_cols].astype(np.float32)
+
+        return write_parquet(df, 'features')
 
 
     @task.python()
-    def grid_search_cv(df: pd.DataFrame, **kwargs):
+    def grid_search_cv(features_uri: str, **kwargs):
         """Train and validate model using a grid search for the optimal parameter values and a five fold cross validation.
         
         Returns accuracy score via XCom to GCS bucket.
 
         Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
+        features_uri -- GCS URI of the Parquet features built in the previous step.
         """
 
         import mlflow
 
-        mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-        try:
-            # Creating an experiment
-            mlflow.create_experiment('census_prediction')
-        except:
-            pass
-        # Setting the environment with the created experiment
-        mlflow.set_experiment('census_prediction')
+        init_mlflow()
 
-        mlflow.sklearn.autolog()
-        mlflow.lightgbm.autolog()
+        # LightGBM autolog posts every boosting round, the final fit logs a single summary instead
+        mlflow.lightgbm.autolog(disable=True)
+
+        df = read_parquet(features_uri)
 
         y = df['never_married']
         X = df.drop(columns=['never_married'])
 
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=55, stratify=y)
-        train_set = lgb.Dataset(X_train, label=y_train)
-        test_set = lgb.Dataset(X_test, label=y_test)
 
-        params = {'objective': 'binary', 'metric': ['auc', 'binary_logloss']}
+        params = {**LGB_BASE_PARAMS}
+
+        # Bin the features once, every CV fold and grid candidate reuses the same bin mappers
+        train_set = lgb.Dataset(X_train, label=y_train, params=params, free_raw_data=False).construct()
+        test_set = lgb.Dataset(X_test, label=y_test, reference=train_set)
 
         grid_params = {
             'learning_rate': [0.01, .05, .1], 
@@ -150,27 +142,28 @@ def mlflow_example():
             'max_depth': [16, 24, 31, 40]
             }
 
-        model = lgb.LGBMClassifier(**params)
-        grid_search = GridSearchCV(model, param_grid=grid_params, verbose=1, cv=5, n_jobs=-1)
-
         with mlflow.start_run(run_name=f'LGBM {kwargs["run_id"]}'):
 
             logging.info('Performing Gridsearch')
-            grid_search.fit(X_train, y_train)
+            best_params, cv_auc_score, best_rounds = lgb_grid_search(params, train_set, grid_params)
 
-            logging.info(f'Best Parameters\n{grid_search.best_params_}')
-            best_params = grid_search.best_params_
+            logging.info(f'Best Parameters\n{best_params}')
+            mlflow.log_params({f'best_{name}': value for name, value in best_params.items()})
+            mlflow.log_metrics({'cv_auc_score': cv_auc_score, 'cv_best_iteration': best_rounds})
             best_params['metric'] = ['auc', 'binary_logloss']
 
 
             logging.info('Training model with best parameters')
+            evals = {}
             clf = lgb.train(
                 train_set=train_set,
                 valid_sets=[train_set, test_set],
                 valid_names=['train', 'validation'],
-                params=best_params,
-                early_stopping_rounds=5
+                params={**params, **best_params},
+                early_stopping_rounds=5,
+                callbacks=[lgb.record_evaluation(evals)]
             )
+            mlflow.log_metrics({'train_auc_last': evals['train']['auc'][-1], 'val_auc_last': evals['validation']['auc'][-1]})
 
             logging.info('Gathering Validation set results')
             y_pred_class = metrics.test(clf, X_test)
@@ -180,8 +173,7 @@ def mlflow_example():
 
 
     df = load_data()
-    clean_data = preprocessing(df)
-    features = feature_engineering(clean_data)
+    features = prepare_features(df)
     grid_search_cv(features)
 
     
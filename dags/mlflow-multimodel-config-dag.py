@@ -19,16 +19,24 @@ from airflow.operators.python import get_current_context
 from datetime import datetime
 
 import logging
+import os
 
+import joblib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, HalvingGridSearchCV
 from sklearn.linear_model import LogisticRegression
 import lightgbm as lgb
 
 
 from include.grid_configs import models, params
+from include.lgbm_search import LGB_BASE_PARAMS, lgb_grid_search
 import include.metrics as metrics
+from include.mlflow_setup import init_mlflow
+from include.gcs_parquet import read_parquet, write_parquet
 
 
 
@@ -51,165 +59,195 @@ def mlflow_multimodel_config_example():
         SELECT * FROM `bigquery-public-data.ml_datasets.census_adult_income`
         """
 
-        return bq.get_pandas_df(sql=sql, dialect='standard')
+        # Stream the result set as Arrow record batches over the BigQuery Storage Read API
+        result = bq.get_client().query(sql).result()
+        return result.to_arrow(create_bqstorage_client=True).to_pandas(
+            types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get
+        )
 
 
     @task
-    def preprocessing(df: pd.DataFrame):
-        """Clean Data and prepare for feature engineering
+    def prepare_features(df: pd.DataFrame):
+        """Clean Data and build model features
         
-        Returns pandas dataframe via Xcom to GCS bucket.
+        Returns GCS URI of the features saved as Parquet via XCom.
 
         Keyword arguments:
         df -- Raw data pulled from BigQuery to be processed. 
         """
 
-        df.dropna(inplace=True)
-        df.drop_duplicates(inplace=True)
+        # Drop incomplete rows, then duplicates, renumbering the index in the same pass
+        df = df.dropna().drop_duplicates(ignore_index=True)
 
         # Clean Categorical Variables (strings)
-        cols = df.columns
-        for col in cols:
-            if df.dtypes[col]=='object':
-                df[col] =df[col].apply(lambda x: x.rstrip().lstrip())
+        obj_cols = df.select_dtypes(include=['object', 'string']).columns
+        df[obj_cols] = df[obj_cols].apply(lambda s: s.str.strip())
 
 
         # Rename up '?' values as 'Unknown'
-        df['workclass'] = df['workclass'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['occupation'] = df['occupation'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['native_country'] = df['native_country'].apply(lambda x: 'Unknown' if x == '?' else x)
+        unknown_cols = ['workclass', 'occupation', 'native_country']
+        df[unknown_cols] = df[unknown_cols].replace('?', 'Unknown')
+
+        # Store low cardinality strings as categoricals so get_dummies and comparisons run on integer codes
+        cat_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country', 'marital_status']
+        df[cat_cols] = df[cat_cols].astype('category')
 
         # Drop Extra/Unused Columns
         df.drop(columns=['education_num', 'relationship', 'functional_weight'], inplace=True)
 
-        return df
+        # Onehot encoding
+        dummy_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country']
+        df = pd.get_dummies(df, columns=dummy_cols, dtype=np.int8)
+
+        # Bin Ages
+        df['age_bins'] = (np.digitize(df['age'].to_numpy(), bins=[29, 39, 49, 59], right=True) + 1).astype(np.int8)
+
+        # Dependent Variable
+        df['never_married'] = (df['marital_status'] == 'Never-married').astype(np.int8)
+
+        # Drop redundant column
+        df.drop(columns=['income_bracket_<=50K', 'marital_status', 'age'], inplace=True)
+
+        # Downcast remaining numeric columns, LightGBM bins float32 and sklearn accepts it as is
+        float_cols = df.select_dtypes(include=['float64', 'int64']).columns
+        df[float_cols] = df[float_cols].astype(np.float32)
+
+        return write_parquet(df, 'features')
+
 
     @task
-    def feature_engineering(df: pd.DataFrame):
-        """Feature engineering step
+    def split(features_uri: str):
+        """Split features into a train and test set shared by every model
         
-        Returns pandas dataframe via XCom to GCS bucket.
+        Returns GCS URIs of the splits saved as Parquet via XCom.
 
         Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
+        features_uri -- GCS URI of the Parquet features built in the previous step.
         """
-        
-        # Onehot encoding 
-        df = pd.get_dummies(df, prefix='workclass', columns=['workclass'])
-        df = pd.get_dummies(df, prefix='education', columns=['education'])
-        df = pd.get_dummies(df, prefix='occupation', columns=['occupation'])
-        df = pd.get_dummies(df, prefix='race', columns=['race'])
-        df = pd.get_dummies(df, prefix='sex', columns=['sex'])
-        df = pd.get_dummies(df, prefix='income_bracket', columns=['income_bracket'])
-        df = pd.get_dummies(df, prefix='native_country', columns=['native_country'])
-
-        # Bin Ages
-        df['age_bins'] = pd.cut(x=df['age'], bins=[16,29,39,49,59,100], labels=[1, 2, 3, 4, 5])
 
-        # Dependent Variable
-        df['never_married'] = df['marital_status'].apply(lambda x: 1 if x == 'Never-married' else 0) 
+        df = read_parquet(features_uri)
+        y = df.pop('never_married')
 
-        # Drop redundant column
-        df.drop(columns=['income_bracket_<=50K', 'marital_status', 'age'], inplace=True)
+        X_train, X_test, y_train, y_test = train_test_split(df, y, test_size=0.2, random_state=55, stratify=y)
 
-        return df
+        return {
+            'X_train': write_parquet(X_train, 'X_train'),
+            'X_test': write_parquet(X_test, 'X_test'),
+            'y_train': write_parquet(y_train.to_frame(), 'y_train'),
+            'y_test': write_parquet(y_test.to_frame(), 'y_test'),
+        }
 
 
     @task_group(group_id='grid_search_cv')
-    def grid_search_cv(features: pd.DataFrame):
+    def grid_search_cv(splits: dict):
         """Train and validate model using a grid search for the optimal parameter values and a five fold cross validation.
         
         Returns accuracy score via XCom to GCS bucket.
 
         Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
+        splits -- GCS URIs of the train and test sets built in the previous step.
         """
 
-        tasks = []
-
-        for k in models:
-            @task(task_id=k)
-            def train(df: pd.DataFrame, model_type=k,model=models[k], grid_params=params[k], **kwargs):
-
-                import mlflow
-
-                mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-                try:
-                    # Creating an experiment
-                    mlflow.create_experiment('census_prediction')
-                except:
-                    pass
-                # Setting the environment with the created experiment
-                mlflow.set_experiment('census_prediction')
-
-                mlflow.sklearn.autolog()
-                mlflow.lightgbm.autolog()
-
-                logging.info(f'Model: {model_type}')
- 
-                context = get_current_context()
-                dag_run = context["dag_run"]
-                grid_search_config = dag_run.conf
-                logging.info(f'Current Context/Config: {grid_search_config}' )
-                
-                if bool(grid_search_config) and bool(grid_search_config[model_type]):
-                    logging.info('Configs provided at runtime will use those parameters for grid search')
-                    logging.info(grid_search_config[model_type])
-                    grid_params = grid_search_config[model_type]
-                else:
-                    logging.info('Configs not provided at runtime will use default parameters provided in model.py for grid search')
-                    logging.info(params[model_type])
-                    grid_params = params[model_type]
+        @task
+        def train(model_type: str, splits: dict, **kwargs):
 
-                y = df['never_married']
-                X = df.drop(columns=['never_married'])
+            import mlflow
 
-                X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=55, stratify=y)
+            init_mlflow()
 
-                grid_search = GridSearchCV(model, param_grid=grid_params, verbose=1, cv=5, n_jobs=-1)
+            model = models[model_type]
 
-                with mlflow.start_run(run_name=f'{model_type}_{kwargs["run_id"]}'):
+            # Skip model artifacts and per-candidate child runs, each of which is a round-trip to the tracking server
+            mlflow.sklearn.autolog(log_models=False, silent=True, max_tuning_runs=1)
+            # LightGBM autolog posts every boosting round, the final fit logs a single summary instead
+            mlflow.lightgbm.autolog(disable=True)
 
-                    logging.info('Performing Gridsearch')
-                    grid_search.fit(X_train, y_train)
+            logging.info(f'Model: {model_type}')
 
-                    logging.info(f'Best Parameters\n{grid_search.best_params_}')
-                    best_params = grid_search.best_params_
+            context = get_current_context()
+            dag_run = context["dag_run"]
+            grid_search_config = dag_run.conf
+            logging.info(f'Current Context/Config: {grid_search_config}' )
+            
+            if bool(grid_search_config) and bool(grid_search_config[model_type]):
+                logging.info('Configs provided at runtime will use those parameters for grid search')
+                logging.info(grid_search_config[model_type])
+                grid_params = grid_search_config[model_type]
+            else:
+                logging.info('Configs not provided at runtime will use default parameters provided in model.py for grid search')
+                logging.info(params[model_type])
+                grid_params = params[model_type]
+
+            X_train = read_parquet(splits['X_train'])
+            X_test = read_parquet(splits['X_test'])
+            y_train = read_parquet(splits['y_train'])['never_married']
+            y_test = read_parquet(splits['y_test'])['never_married']
+
+            # Share the worker's CPUs between the models training in parallel
+            n_jobs = max(1, (os.cpu_count() or 2) // len(models))
+
+            with mlflow.start_run(run_name=f'{model_type}_{kwargs["run_id"]}'):
+
+                logging.info('Performing Gridsearch')
+
+                if model_type == 'lgbm':
 
-                    if model_type == 'lgbm':
+                    base_params = {**LGB_BASE_PARAMS, 'num_threads': n_jobs}
 
-                        train_set = lgb.Dataset(X_train, label=y_train)
-                        test_set = lgb.Dataset(X_test, label=y_test)
+                    # Bin the features once, every CV fold and grid candidate reuses the same bin mappers
+                    train_set = lgb.Dataset(X_train, label=y_train, params=base_params, free_raw_data=False).construct()
+                    test_set = lgb.Dataset(X_test, label=y_test, reference=train_set)
 
-                        best_params['metric'] = ['auc', 'binary_logloss']
+                    best_params, cv_auc_score, best_rounds = lgb_grid_search(base_params, train_set, grid_params)
 
-                        logging.info(f'Training {model_type} model with best parameters')
-                        clf = lgb.train(
-                            train_set=train_set,
-                            valid_sets=[train_set, test_set],
-                            valid_names=['train', 'validation'],
-                            params=best_params,
-                            early_stopping_rounds=5
-                        )
-                        
-                    else:
-                        logging.info(f'Training {model_type} model with best parameters')
-                        clf = LogisticRegression(penalty=best_params['penalty'], C=best_params['C'], solver=best_params['solver']).fit(X_train, y_train)
+                    logging.info(f'Best Parameters\n{best_params}')
+                    mlflow.log_params({f'best_{name}': value for name, value in best_params.items()})
+                    mlflow.log_metrics({'cv_auc_score': cv_auc_score, 'cv_best_iteration': best_rounds})
+
+                    best_params['metric'] = ['auc', 'binary_logloss']
+
+                    logging.info(f'Training {model_type} model with best parameters')
+                    evals = {}
+                    clf = lgb.train(
+                        train_set=train_set,
+                        valid_sets=[train_set, test_set],
+                        valid_names=['train', 'validation'],
+                        params={**base_params, **best_params},
+                        early_stopping_rounds=5,
+                        callbacks=[lgb.record_evaluation(evals)]
+                    )
+                    mlflow.log_metrics({'train_auc_last': evals['train']['auc'][-1], 'val_auc_last': evals['validation']['auc'][-1]})
+
+                else:
+                    # Convert once to a single float32 block so every CV fit can use it without copying
+                    X_train = X_train.astype(np.float32)
+
+                    # Invalid penalty/solver combinations fail to fit, score them -inf so halving prunes them first
+                    grid_search = HalvingGridSearchCV(model, param_grid=grid_params, verbose=1, cv=5, factor=3, resource='n_samples', random_state=55, error_score=-np.inf, n_jobs=n_jobs)
+                    with joblib.parallel_backend('loky', inner_max_num_threads=1):
+                        grid_search.fit(X_train, y_train)
+
+                    logging.info(f'Best Parameters\n{grid_search.best_params_}')
+                    best_params = grid_search.best_params_
+                    # Autolog only records best_* params for GridSearchCV/RandomizedSearchCV
+                    mlflow.log_params({f'best_{name}': value for name, value in best_params.items()})
 
-                    y_pred_class = metrics.test(clf, X_test)
+                    logging.info(f'Training {model_type} model with best parameters')
+                    clf = LogisticRegression(penalty=best_params['penalty'], C=best_params['C'], solver=best_params['solver']).fit(X_train, y_train)
 
-                    # Log Classfication Report, Confusion Matrix, and ROC Curve
-                    metrics.log_all_eval_metrics(y_test, y_pred_class)
+                y_pred_class = metrics.test(clf, X_test)
 
-            tasks.append(train(features))
+                # Log Classfication Report, Confusion Matrix, and ROC Curve
+                metrics.log_all_eval_metrics(y_test, y_pred_class)
 
-        return tasks
+        # One mapped task instance per model, expanded by the scheduler at runtime
+        return train.partial(splits=splits).expand(model_type=list(models))
 
 
     df = load_data()
-    clean_data = preprocessing(df)
-    features = feature_engineering(clean_data)
-    grid_search_cv(features)
+    features = prepare_features(df)
+    splits = split(features)
+    grid_search_cv(splits)
 
     
 dag = mlflow_multimodel_config_example()
@@ -14,21 +14,39 @@ By using an external XCom backend, users can easily push and pull all intermedia
 """
 
 from airflow.decorators import task, dag, task_group
+from airflow.exceptions import AirflowException
 from airflow.providers.google.cloud.hooks.bigquery import BigQueryHook
 
 from datetime import datetime
 
+import ast
 import logging
+import os
+import re
 from airflow.utils.log.logging_mixin import LoggingMixin
 
+import joblib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, HalvingGridSearchCV
 from sklearn.linear_model import LogisticRegression
 import lightgbm as lgb
 
 import include.metrics as metrics
+from include.mlflow_setup import init_mlflow
+from include.gcs_parquet import read_parquet, write_parquet
 from include.grid_configs import models, params
+from include.lgbm_search import LGB_BASE_PARAMS, lgb_grid_search
+
+
+NUMERIC_PARAM = re.compile(r'^-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+
+
+def _looks_numeric(value: str) -> bool:
+    return bool(NUMERIC_PARAM.match(value))
 
 
 @dag(
@@ -48,257 +66,266 @@ def mlflow_multimodel_register_example():
         SELECT * FROM `bigquery-public-data.ml_datasets.census_adult_income`
         """
 
-        return bq.get_pandas_df(sql=sql, dialect='standard')
+        # Stream the result set as Arrow record batches over the BigQuery Storage Read API
+        result = bq.get_client().query(sql).result()
+        return result.to_arrow(create_bqstorage_client=True).to_pandas(
+            types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get
+        )
 
 
     @task
-    def preprocessing(df: pd.DataFrame):
-        """Clean Data and prepare for feature engineering
+    def prepare_features(df: pd.DataFrame):
+        """Clean Data and build model features
         
-        Returns pandas dataframe via Xcom to GCS bucket.
+        Returns GCS URI of the features saved as Parquet via XCom.
 
         Keyword arguments:
         df -- Raw data pulled from BigQuery to be processed. 
         """
 
-        df.dropna(inplace=True)
-        df.drop_duplicates(inplace=True)
+        # Drop incomplete rows, then duplicates, renumbering the index in the same pass
+        df = df.dropna().drop_duplicates(ignore_index=True)
 
         # Clean Categorical Variables (strings)
-        cols = df.columns
-        for col in cols:
-            if df.dtypes[col]=='object':
-                df[col] =df[col].apply(lambda x: x.rstrip().lstrip())
+        obj_cols = df.select_dtypes(include=['object', 'string']).columns
+        df[obj_cols] = df[obj_cols].apply(lambda s: s.str.strip())
 
 
         # Rename up '?' values as 'Unknown'
-        df['workclass'] = df['workclass'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['occupation'] = df['occupation'].apply(lambda x: 'Unknown' if x == '?' else x)
-        df['native_country'] = df['native_country'].apply(lambda x: 'Unknown' if x == '?' else x)
+        unknown_cols = ['workclass', 'occupation', 'native_country']
+        df[unknown_cols] = df[unknown_cols].replace('?', 'Unknown')
+
+        # Store low cardinality strings as categoricals so get_dummies and comparisons run on integer codes
+        cat_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country', 'marital_status']
+        df[cat_cols] = df[cat_cols].astype('category')
 
 
         # Drop Extra/Unused Columns
         df.drop(columns=['education_num', 'relationship', 'functional_weight'], inplace=True)
 
-        return df
+        # Onehot encoding
+        dummy_cols = ['workclass', 'education', 'occupation', 'race', 'sex', 'income_bracket', 'native_country']
+        df = pd.get_dummies(df, columns=dummy_cols, dtype=np.int8)
+
+        # Bin Ages
+        df['age_bins'] = (np.digitize(df['age'].to_numpy(), bins=[29, 39, 49, 59], right=True) + 1).astype(np.int8)
+
+        # Dependent Variable
+        df['never_married'] = (df['marital_status'] == 'Never-married').astype(np.int8)
+
+        # Drop redundant column
+        df.drop(columns=['income_bracket_<=50K', 'marital_status', 'age'], inplace=True)
+
+        # Downcast remaining numeric columns, LightGBM bins float32 and sklearn accepts it as is
+        float_cols = df.select_dtypes(include=['float64', 'int64']).columns
+        df[float_cols] = df[float_cols].astype(np.float32)
+
+        return write_parquet(df, 'features')
 
 
     @task
-    def feature_engineering(df: pd.DataFrame):
-        """Feature engineering step
+    def split(features_uri: str):
+        """Split features into a train and test set shared by every model
         
-        Returns pandas dataframe via XCom to GCS bucket.
+        Returns GCS URIs of the splits saved as Parquet via XCom.
 
         Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
+        features_uri -- GCS URI of the Parquet features built in the previous step.
         """
-        
-        # Onehot encoding 
-        df = pd.get_dummies(df, prefix='workclass', columns=['workclass'])
-        df = pd.get_dummies(df, prefix='education', columns=['education'])
-        df = pd.get_dummies(df, prefix='occupation', columns=['occupation'])
-        df = pd.get_dummies(df, prefix='race', columns=['race'])
-        df = pd.get_dummies(df, prefix='sex', columns=['sex'])
-        df = pd.get_dummies(df, prefix='income_bracket', columns=['income_bracket'])
-        df = pd.get_dummies(df, prefix='native_country', columns=['native_country'])
-
-        # Bin Ages
-        df['age_bins'] = pd.cut(x=df['age'], bins=[16,29,39,49,59,100], labels=[1, 2, 3, 4, 5])
 
-        # Dependent Variable
-        df['never_married'] = df['marital_status'].apply(lambda x: 1 if x == 'Never-married' else 0) 
+        df = read_parquet(features_uri)
+        y = df.pop('never_married')
 
-        # Drop redundant column
-        df.drop(columns=['income_bracket_<=50K', 'marital_status', 'age'], inplace=True)
+        X_train, X_test, y_train, y_test = train_test_split(df, y, test_size=0.2, random_state=55, stratify=y)
 
-        return df
+        return {
+            'X_train': write_parquet(X_train, 'X_train'),
+            'X_test': write_parquet(X_test, 'X_test'),
+            'y_train': write_parquet(y_train.to_frame(), 'y_train'),
+            'y_test': write_parquet(y_test.to_frame(), 'y_test'),
+        }
 
 
     @task_group(group_id='grid_search_cv')
-    def grid_search_cv(features: pd.DataFrame):
+    def grid_search_cv(splits: dict):
         """Train and validate model using a grid search for the optimal parameter values and a five fold cross validation.
         
         Returns accuracy score via XCom to GCS bucket.
 
         Keyword arguments:
-        df -- data from previous step pulled from BigQuery to be processed. 
+        splits -- GCS URIs of the train and test sets built in the previous step.
         """
 
-        tasks = []
+        @task
+        def train(model_type: str, splits: dict, **kwargs):
 
-        for k in models:
-            @task(task_id=k, multiple_outputs=True)
-            def train(df: pd.DataFrame, model_type=k,model=models[k], grid_params=params[k], **kwargs):
+            import mlflow
 
-                import mlflow
+            init_mlflow()
 
-                mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-                try:
-                    # Creating an experiment
-                    mlflow.create_experiment('census_prediction')
-                except:
-                    pass
-                # Setting the environment with the created experiment
-                mlflow.set_experiment('census_prediction')
+            model = models[model_type]
+            grid_params = params[model_type]
 
-                mlflow.sklearn.autolog()
-                mlflow.lightgbm.autolog()
+            # Skip model artifacts and per-candidate child runs, each of which is a round-trip to the tracking server
+            mlflow.sklearn.autolog(log_models=False, silent=True, max_tuning_runs=1)
+            # LightGBM autolog posts every boosting round, the final fit logs a single summary instead
+            mlflow.lightgbm.autolog(disable=True)
 
-                y = df['never_married']
-                X = df.drop(columns=['never_married'])
+            X_train = read_parquet(splits['X_train'])
+            X_test = read_parquet(splits['X_test'])
+            y_train = read_parquet(splits['y_train'])['never_married']
+            y_test = read_parquet(splits['y_test'])['never_married']
 
-                X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=55, stratify=y)
+            # Share the worker's CPUs between the models training in parallel
+            n_jobs = max(1, (os.cpu_count() or 2) // len(models))
 
-                grid_search = GridSearchCV(model, param_grid=grid_params, verbose=1, cv=5, n_jobs=-1)
+            with mlflow.start_run(run_name=f'{model_type}_{kwargs["run_id"]}') as run:
 
-                with mlflow.start_run(run_name=f'{model_type}_{kwargs["run_id"]}') as run:
+                # Lets get_best_model fetch this DAG run's candidates with a single search
+                mlflow.set_tag('airflow_run_id', kwargs['run_id'])
 
-                    logging.info('Performing Gridsearch')
-                    grid_search.fit(X_train, y_train)
+                logging.info('Performing Gridsearch')
 
-                    logging.info(f'Best Parameters\n{grid_search.best_params_}')
-                    best_params = grid_search.best_params_
+                if model_type == 'lgbm':
+
+                    base_params = {**LGB_BASE_PARAMS, 'num_threads': n_jobs}
+
+                    # Bin the features once, every CV fold and grid candidate reuses the same bin mappers
+                    train_set = lgb.Dataset(X_train, label=y_train, params=base_params, free_raw_data=False).construct()
+                    test_set = lgb.Dataset(X_test, label=y_test, reference=train_set)
 
-                    if model_type == 'lgbm':
+                    best_params, cv_auc_score, best_rounds = lgb_grid_search(base_params, train_set, grid_params)
 
-                        train_set = lgb.Dataset(X_train, label=y_train)
-                        test_set = lgb.Dataset(X_test, label=y_test)
+                    logging.info(f'Best Parameters\n{best_params}')
+                    mlflow.log_params({f'best_{name}': value for name, value in best_params.items()})
+                    mlflow.log_metrics({'cv_auc_score': cv_auc_score, 'cv_best_iteration': best_rounds})
 
-                        best_params['metric'] = ['auc', 'binary_logloss']
+                    best_params['metric'] = ['auc', 'binary_logloss']
 
-                        logging.info('Training model with best parameters')
-                        clf = lgb.train(
-                            train_set=train_set,
-                            valid_sets=[train_set, test_set],
-                            valid_names=['train', 'validation'],
-                            params=best_params,
-                            early_stopping_rounds=5
-                        )
+                    logging.info('Training model with best parameters')
+                    evals = {}
+                    clf = lgb.train(
+                        train_set=train_set,
+                        valid_sets=[train_set, test_set],
+                        valid_names=['train', 'validation'],
+                        params={**base_params, **best_params},
+                        early_stopping_rounds=5,
+                        callbacks=[lgb.record_evaluation(evals)]
+                    )
+                    mlflow.log_metrics({'train_auc_last': evals['train']['auc'][-1], 'val_auc_last': evals['validation']['auc'][-1]})
 
-                    else:
-                        logging.info('Training model with best parameters')
-                        clf = LogisticRegression(penalty=best_params['penalty'], C=best_params['C'], solver=best_params['solver']).fit(X_train, y_train)
+                    # Autologging skips models, keep the tuned booster so build_best_model can refit it
+                    mlflow.lightgbm.log_model(clf, 'model')
 
-                    y_pred_class = metrics.test(clf, X_test)
+                else:
+                    # Convert once to a single float32 block so every CV fit can use it without copying
+                    X_train = X_train.astype(np.float32)
+
+                    # Invalid penalty/solver combinations fail to fit, score them -inf so halving prunes them first
+                    grid_search = HalvingGridSearchCV(model, param_grid=grid_params, verbose=1, cv=5, factor=3, resource='n_samples', random_state=55, error_score=-np.inf, n_jobs=n_jobs)
+                    with joblib.parallel_backend('loky', inner_max_num_threads=1):
+                        grid_search.fit(X_train, y_train)
+
+                    logging.info(f'Best Parameters\n{grid_search.best_params_}')
+                    best_params = grid_search.best_params_
+                    # Autolog only records best_* params for GridSearchCV/RandomizedSearchCV
+                    mlflow.log_params({f'best_{name}': value for name, value in best_params.items()})
+
+                    logging.info('Training model with best parameters')
+                    clf = LogisticRegression(penalty=best_params['penalty'], C=best_params['C'], solver=best_params['solver']).fit(X_train, y_train)
+
+                y_pred_class = metrics.test(clf, X_test)
 
-                    # Log Classfication Report, Confustion Matrix, and ROC Curve
-                    metrics.log_all_eval_metrics(y_test, y_pred_class)
+                # Log Classfication Report, Confustion Matrix, and ROC Curve
+                metrics.log_all_eval_metrics(y_test, y_pred_class)
 
-                    return {'run_id': run.info.run_id, 'model_type': model_type}
-                
-            run_id = train(features)
-            tasks.append(run_id)
+                return {'run_id': run.info.run_id, 'model_type': model_type}
 
-        return tasks
+        # One mapped task instance per model, expanded by the scheduler at runtime
+        return train.partial(splits=splits).expand(model_type=list(models))
 
 
     @task(multiple_outputs=True)
-    def get_best_model(run_ids: list):
+    def get_best_model(run_ids: list, **kwargs):
 
         import mlflow
 
-        mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-        try:
-            # Creating an experiment
-            mlflow.create_experiment('census_prediction')
-        except:
-            pass
-        # Setting the environment with the created experiment
-        mlflow.set_experiment('census_prediction')
+        init_mlflow()
 
         logging.info(run_ids)
 
-        best = {
-            'run_id': '',
-            'model': '',
-            'auc_score': 0,
-            'accuracy': 0
-        }
-        
-        for run_id in run_ids:
-
-            logging.info(run_id['run_id'])
-
-            run_data = mlflow.get_run(run_id['run_id']).data.to_dictionary()
-            auc_score = run_data['metrics']['test_auc_score']
-            accuracy = run_data['metrics']['accuracy']
-
-            logging.info(f'AUC Score: {auc_score}')
-            logging.info(f'Accuracy: {accuracy}')
-
-            if auc_score > best['auc_score']:
-                best['auc_score'] = auc_score
-                best['accuracy'] = accuracy
-                best['run_id'] = run_id['run_id']
-                best['model'] = run_id['model_type']
-            elif auc_score == best['auc_score'] and accuracy > best['accuracy']:
-                best['auc_score'] = auc_score
-                best['accuracy'] = accuracy
-                best['run_id'] = run_id['run_id']
-                best['model'] = run_id['model_type']
-            else:
-                pass
-        
-        logging.info(best)
+        # Fetch this DAG run's candidates in a single request, run_id is not searchable in mlflow 1.23 but tags are
+        model_types = {run['run_id']: run['model_type'] for run in run_ids}
+        runs_df = mlflow.search_runs(filter_string=f"tags.airflow_run_id = '{kwargs['run_id']}'")
+        # Retried train attempts leave extra tagged runs, only keep the ones the mapped tasks returned
+        runs_df = runs_df[runs_df['run_id'].isin(model_types)]
 
-        best_params = {}
-        best_run = mlflow.get_run(best['run_id']).data.to_dictionary()
-        best_run = best_run['params']
+        if runs_df.empty:
+            raise AirflowException(f'No MLflow runs tagged with airflow_run_id {kwargs["run_id"]}')
 
-        for k in best_run:
-            if k.startswith('best_'):
+        logging.info(runs_df[['run_id', 'metrics.test_auc_score', 'metrics.accuracy']])
 
-                if '.' in best_run[k]:
-                    best_params[k[len('best_'):]] = float(best_run[k])
-                elif best_run[k].isdigit():
-                    best_params[k[len('best_'):]] = int(best_run[k])
-                else:
-                    best_params[k[len('best_'):]] = best_run[k]
+        # Highest AUC wins, accuracy breaks ties
+        best_run = runs_df.sort_values(['metrics.test_auc_score', 'metrics.accuracy'], ascending=False).iloc[0]
+
+        best = {
+            'run_id': best_run['run_id'],
+            'model': model_types[best_run['run_id']],
+            'auc_score': best_run['metrics.test_auc_score'],
+            'accuracy': best_run['metrics.accuracy']
+        }
+
+        logging.info(best)
 
+        # Runs of other model types leave their best_* columns empty
+        # MLflow stores params as strings, turn ints/floats (including 1e-3 style) back into numbers
+        best_run = best_run[runs_df.columns[runs_df.columns.str.startswith('params.best_')]].dropna()
+        best_params = {
+            k[len('params.best_'):]: ast.literal_eval(v) if _looks_numeric(v) else v
+            for k, v in best_run.items()
+        }
 
         logging.info(best_params)
 
-        return {'params': best_params, 'model_type': best['model']}
+        return {'params': best_params, 'model_type': best['model'], 'run_id': best['run_id']}
 
 
     @task
-    def build_best_model(model_params: dict, features: pd.DataFrame, **kwargs):
+    def build_best_model(model_params: dict, features_uri: str, **kwargs):
 
         import mlflow
 
-        mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-        try:
-            # Creating an experiment
-            mlflow.create_experiment('census_prediction')
-        except:
-            pass
-        # Setting the environment with the created experiment
-        mlflow.set_experiment('census_prediction')
+        init_mlflow()
 
         logging.info(model_params)
 
+        features = read_parquet(features_uri)
+
         y = features['never_married']
         X = features.drop(columns=['never_married'])
 
-        train_set = lgb.Dataset(X, label=y)
-
         with mlflow.start_run(run_name=f'{model_params["model_type"]}_{kwargs["run_id"]}_best') as run:
 
             if model_params['model_type'] == 'lgbm':
-                
-                base_params = {'objective':'binary', 'metric':['auc', 'binary_logloss'], 'boosting_type':'gbdt'}
-                all_params = {**base_params, **model_params['params']}
 
-                lgb.train(
-                    train_set=train_set,
-                    params=all_params
-                )
+                # Keep the tuned trees and only refit their leaf values on the full dataset
+                booster = mlflow.lightgbm.load_model(f'runs:/{model_params["run_id"]}/model')
+                # Boosters loaded from a model file have no params and refit would fall back to regression,
+                # restore the ones train used
+                booster.params = {**LGB_BASE_PARAMS, **model_params['params']}
+                # decay_rate=0 recomputes every leaf from the full data instead of blending with the old values
+                booster = booster.refit(X, y, decay_rate=0.0)
+
+                mlflow.lightgbm.log_model(booster, 'model')
 
             else:
-                base_params = {'max_iter': 500}
+                # The tuned penalty/C/solver override these defaults
+                base_params = {'solver': 'saga', 'penalty': 'l2', 'C': 1.0, 'max_iter': 500}
                 all_params = {**base_params, **model_params['params']}
 
-                LogisticRegression(params=all_params)  
+                clf = LogisticRegression(n_jobs=-1, **all_params).fit(X.astype(np.float32), y)
+
+                mlflow.sklearn.log_model(clf, 'model')
         
             return run.info.run_id
 
@@ -307,14 +334,7 @@ def mlflow_multimodel_register_example():
     def register_model(model_run_id: str):
         import mlflow
 
-        mlflow.set_tracking_uri('http://mlflow.mlflow.svc')
-        try:
-            # Creating an experiment
-            mlflow.create_experiment('census_prediction')
-        except:
-            pass
-        # Setting the environment with the created experiment
-        mlflow.set_experiment('census_prediction')
+        init_mlflow()
         
         mv = mlflow.register_model(f'runs:/{model_run_id}/model', 'census_pred',)
 
@@ -331,9 +351,9 @@ def mlflow_multimodel_register_example():
 
 
     df = load_data()
-    clean_data = preprocessing(df)
-    features = feature_engineering(clean_data)
-    run_ids = grid_search_cv(features)
+    features = prepare_features(df)
+    splits = split(features)
+    run_ids = grid_search_cv(splits)
     best_model_params = get_best_model(run_ids)
     final_model_run_id = build_best_model(best_model_params, features)
     register_model(final_model_run_id)
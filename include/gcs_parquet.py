@@ -0,0 +1,33 @@
+from airflow.providers.google.cloud.hooks.gcs import GCSHook
+
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+import uuid
+
+
+PREFIX = "gs://"
+BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+
+
+def write_parquet(df: pd.DataFrame, name: str = "data") -> str:
+    """Upload a dataframe to GCS as a zstd compressed Parquet file and return its URI"""
+    object_name = f"{name}_{uuid.uuid4()}.parquet"
+    with GCSHook().provide_file_and_upload(
+            bucket_name=BUCKET_NAME,
+            object_name=object_name,
+    ) as f:
+        df.to_parquet(f.name, engine='pyarrow', compression='zstd', index=False)
+    return f"{PREFIX}{BUCKET_NAME}/{object_name}"
+
+
+def read_parquet(uri: str) -> pd.DataFrame:
+    """Download a Parquet file written by write_parquet"""
+    bucket_name, object_name = uri[len(PREFIX):].split("/", 1)
+    with GCSHook().provide_file(
+            bucket_name=bucket_name,
+            object_name=object_name,
+    ) as f:
+        f.flush()
+        # Multithreaded Arrow reader
+        return ds.dataset(f.name, format='parquet').to_table().to_pandas()
@@ -0,0 +1,40 @@
+import logging
+
+import lightgbm as lgb
+from sklearn.model_selection import ParameterGrid
+
+
+# Shared by tuning, the final fit and build_best_model's refit so they all train the same kind of model
+LGB_BASE_PARAMS = {'objective': 'binary', 'boosting_type': 'gbdt', 'seed': 55, 'verbose': -1}
+
+
+def lgb_grid_search(base_params: dict, train_set: lgb.Dataset, grid_params: dict, nfold: int = 5, early_stopping_rounds: int = 20):
+    """Cross validate every grid combination with LightGBM's native cv and early stopping.
+
+    Returns the best grid parameters, their mean validation AUC and the number of boosting rounds kept.
+
+    Keyword arguments:
+    base_params -- LightGBM parameters shared by every candidate (objective, seed, ...).
+    train_set -- training data; binned once and reused across folds and candidates.
+    grid_params -- parameter grid in the same format as sklearn's GridSearchCV.
+    """
+
+    best = {'params': {}, 'auc': 0, 'rounds': 0}
+
+    for candidate in ParameterGrid(grid_params):
+        cv_results = lgb.cv(
+            params={**base_params, **candidate, 'metric': 'auc'},
+            train_set=train_set,
+            nfold=nfold,
+            stratified=True,
+            callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)]
+        )
+
+        # With early stopping the history is truncated at the best iteration
+        auc_score = cv_results['auc-mean'][-1]
+        logging.info(f'{candidate} AUC: {auc_score:.4f}')
+
+        if auc_score > best['auc']:
+            best = {'params': candidate, 'auc': auc_score, 'rounds': len(cv_results['auc-mean'])}
+
+    return best['params'], best['auc'], best['rounds']
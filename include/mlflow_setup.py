@@ -0,0 +1,15 @@
+from functools import lru_cache
+
+import mlflow
+
+
+TRACKING_URI = 'http://mlflow.mlflow.svc'
+EXPERIMENT_NAME = 'census_prediction'
+
+
+@lru_cache(maxsize=1)
+def init_mlflow():
+    """Point MLflow at the tracking server and census experiment, repeat calls in the same process are no-ops"""
+    mlflow.set_tracking_uri(TRACKING_URI)
+    # Creates the experiment if it does not exist yet
+    mlflow.set_experiment(EXPERIMENT_NAME)